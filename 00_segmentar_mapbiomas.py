@@ -1,4 +1,10 @@
 # 08_gerar_vetores_mapbiomas_simplificado.py
+#
+# O raster do MapBiomas é lido uma única vez e reaproveitado por todos os
+# grupos. Para usos em resolução reduzida, gere as pirâmides (overviews)
+# uma vez, fora do script:
+#
+#   gdal_addo -r nearest ./dados/mapbiomas_campo_verde.tif 2 4 8 16
 import rasterio
 from rasterio.features import shapes
 import geopandas as gpd
@@ -43,56 +49,58 @@ GRUPOS_MAPBIOMAS = {
 }
 
 
-def vetorizar_classes(raster_path, class_ids, group_name, output_dir):
+def vetorizar_classes(
+    mapbiomas_array, transform, crs, class_ids, group_name, output_dir
+):
     print(f"\Processando grupo: {group_name}")
 
     try:
-        with rasterio.open(raster_path) as src:
-            mapbiomas_array = src.read(1)
-
-            mascara_binaria = np.isin(mapbiomas_array, class_ids).astype(
-                np.uint8
+        # Tabela de consulta de 256 entradas: uma indexação por pixel no
+        # lugar do teste de pertinência do np.isin
+        lut = np.zeros(256, dtype=np.uint8)
+        lut[np.asarray(class_ids, dtype=np.uint8)] = 1
+        mascara_binaria = lut[mapbiomas_array]
+
+        total_pixels = np.count_nonzero(mascara_binaria)
+        if total_pixels == 0:
+            print(
+                f"   - Nenhuma área encontrada para o grupo '{group_name}'. Pulando."
             )
-
-            if np.sum(mascara_binaria) == 0:
-                print(
-                    f"   - Nenhuma área encontrada para o grupo '{group_name}'. Pulando."
-                )
-                return
-
-            results = (
-                {'properties': {'raster_val': v}, 'geometry': s}
-                for i, (s, v) in enumerate(
-                    shapes(
-                        mascara_binaria,
-                        mask=mascara_binaria,
-                        transform=src.transform,
-                    )
+            return
+
+        results = (
+            {'properties': {'raster_val': v}, 'geometry': s}
+            for i, (s, v) in enumerate(
+                shapes(
+                    mascara_binaria,
+                    mask=mascara_binaria,
+                    transform=transform,
                 )
             )
+        )
 
-            geoms = list(results)
-            if not geoms:
-                print(
-                    f"   - Não foi possível gerar polígonos para o grupo '{group_name}'."
-                )
-                return
+        geoms = list(results)
+        if not geoms:
+            print(
+                f"   - Não foi possível gerar polígonos para o grupo '{group_name}'."
+            )
+            return
 
-            gdf = gpd.GeoDataFrame.from_features(geoms, crs=src.crs)
+        gdf = gpd.GeoDataFrame.from_features(geoms, crs=crs)
 
-            gdf['classe'] = group_name
+        gdf['classe'] = group_name
 
-            gdf['pixels'] = np.sum(mascara_binaria)
-            gdf['area_m2'] = gdf['pixels'] * 100
-            gdf['area_ha'] = gdf['area_m2'] / 10000
+        gdf['pixels'] = total_pixels
+        gdf['area_m2'] = gdf['pixels'] * 100
+        gdf['area_ha'] = gdf['area_m2'] / 10000
 
-            output_path = os.path.join(
-                output_dir, f"mapbiomas_{group_name}.shp"
-            )
-            gdf.to_file(output_path)
+        output_path = os.path.join(
+            output_dir, f"mapbiomas_{group_name}.shp"
+        )
+        gdf.to_file(output_path)
 
-            print(f"   - Shapefile salvo em: {output_path}")
-            print(f"   - Polígonos gerados: {len(gdf)}")
+        print(f"   - Shapefile salvo em: {output_path}")
+        print(f"   - Polígonos gerados: {len(gdf)}")
 
     except Exception as e:
         print(f"   - Erro ao processar o grupo '{group_name}': {e}")
@@ -101,9 +109,19 @@ def vetorizar_classes(raster_path, class_ids, group_name, output_dir):
 def main():
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+    with rasterio.open(RASTER_MAPBIOMAS) as src:
+        mapbiomas_array = src.read(1)
+        transform = src.transform
+        crs = src.crs
+
     for nome_grupo, ids_de_classe in GRUPOS_MAPBIOMAS.items():
         vetorizar_classes(
-            RASTER_MAPBIOMAS, ids_de_classe, nome_grupo, OUTPUT_DIR
+            mapbiomas_array,
+            transform,
+            crs,
+            ids_de_classe,
+            nome_grupo,
+            OUTPUT_DIR,
         )
 
     print("\nProcessamento concluído!")
@@ -3,6 +3,8 @@ import numpy as np
 import os
 import rasterio
 import glob
+import queue
+import threading
 from tqdm import tqdm
 from transformers import pipeline
 from PIL import Image
@@ -14,6 +16,31 @@ OUTPUT_DIR = f"./dados/mascaras_campo_verde/{MODEL_ID.split('/')[-1]}"
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
+def _ler_patches(tarefas, fila):
+    """
+    Lê os patches em ordem e os coloca na fila como imagens PIL; None indica
+    o fim da leitura.
+
+    As bandas são lidas direto em um array HWC novo a cada patch (sem
+    transpose), no tipo do próprio raster. O array não é reaproveitado: a
+    imagem PIL pode compartilhar a sua memória (ex.: RGBA) enquanto espera
+    na fila.
+    """
+    for image_path, output_path in tarefas:
+        try:
+            with rasterio.open(image_path) as src:
+                image_np = np.empty(
+                    (src.height, src.width, src.count), dtype=src.dtypes[0]
+                )
+                src.read(out=image_np.transpose(2, 0, 1))  # bandas -> HWC
+            fila.put(
+                (image_path, output_path, Image.fromarray(image_np), None)
+            )
+        except Exception as e:
+            fila.put((image_path, output_path, None, e))
+    fila.put(None)
+
+
 def segmentar_patches_com_pipeline():
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
@@ -24,6 +51,15 @@ def segmentar_patches_com_pipeline():
             device=DEVICE,
         )
 
+        if DEVICE.type == "cuda":
+            # O encoder de imagem ViT domina o custo. O processor redimensiona
+            # e completa todo patch para 1024x1024 e a pipeline codifica uma
+            # imagem por vez, então a entrada do encoder compilado tem sempre
+            # o mesmo formato e não há recompilação
+            mask_generator.model.vision_encoder = torch.compile(
+                mask_generator.model.vision_encoder, mode="reduce-overhead"
+            )
+
     except Exception as e:
         print(f"Erro ao carregar a pipeline: {e}")
         return
@@ -35,25 +71,40 @@ def segmentar_patches_com_pipeline():
 
     print(f"Encontrados {len(image_paths)} patches para processar.")
 
-    for image_path in tqdm(
-        image_paths, desc=f"Segmentando com {MODEL_ID.split('/')[-1]}"
-    ):
+    tarefas = []
+    for image_path in image_paths:
         base_name = os.path.basename(image_path)
         output_filename = f"{os.path.splitext(base_name)[0]}_masks.npz"
         output_path = os.path.join(OUTPUT_DIR, output_filename)
 
-        if os.path.exists(output_path):
-            continue
+        if not os.path.exists(output_path):
+            tarefas.append((image_path, output_path))
 
-        try:
-            with rasterio.open(image_path) as src:
-                image_np = src.read()
-                image_np = np.transpose(image_np, (1, 2, 0))
-            image_pil = Image.fromarray(image_np)
+    # A leitura dos patches roda em uma thread separada, enquanto a GPU
+    # segmenta o patch anterior.
+    fila = queue.Queue(maxsize=2)
+    threading.Thread(
+        target=_ler_patches, args=(tarefas, fila), daemon=True
+    ).start()
 
-            outputs = mask_generator(
-                image_pil, points_per_batch=128*2, pred_iou_thresh=0.7
-            )
+    for image_path, output_path, image_pil, erro in tqdm(
+        iter(fila.get, None),
+        total=len(tarefas),
+        desc=f"Segmentando com {MODEL_ID.split('/')[-1]}",
+    ):
+        base_name = os.path.basename(image_path)
+        try:
+            if erro is not None:
+                raise erro
+
+            with torch.inference_mode(), torch.autocast(
+                device_type=DEVICE.type,
+                dtype=torch.bfloat16,
+                enabled=DEVICE.type == "cuda",
+            ):
+                outputs = mask_generator(
+                    image_pil, points_per_batch=128*2, pred_iou_thresh=0.7
+                )
 
             masks = outputs["masks"]
 
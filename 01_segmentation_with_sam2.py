@@ -3,11 +3,16 @@ import numpy as np
 import os
 import rasterio
 import glob
+import queue
+import threading
 from tqdm import tqdm
 import time
 
+from torchvision.ops.boxes import batched_nms
+
 from sam2.sam2_image_predictor import SAM2ImagePredictor
 from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+from sam2.utils.amg import MaskData, batch_iterator, rle_to_mask
 
 MODEL_ID = "facebook/sam2.1-hiera-base-plus"
 
@@ -16,6 +21,156 @@ OUTPUT_DIR = "./dados/mascaras_campo_verde_sam2"
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# Patches codificados juntos em uma única passada do encoder de imagem.
+# Ajustar conforme a VRAM: ~4 para 24GB, 8 para 40GB, 16 para 80GB.
+TAMANHO_LOTE = 4
+
+
+def gerar_mascaras(mask_generator, im_size, pontos):
+    """
+    Gera as máscaras de um patch cujas features já estão no preditor.
+
+    Faz a mesma varredura da grade de pontos e os mesmos filtros (IoU
+    previsto, estabilidade, refinamento m2m, NMS) do
+    SAM2AutomaticMaskGenerator, mas apenas sobre a imagem inteira, sem os
+    recortes adicionais que exigiriam novas passadas do encoder.
+
+    Args:
+        mask_generator: Gerador já configurado (fornece parâmetros e preditor).
+        im_size: Tamanho (altura, largura) do patch.
+        pontos: Grade de pontos em pixels da imagem, formato (N, 2).
+
+    Returns:
+        Lista de máscaras booleanas HW.
+    """
+    crop_box = [0, 0, im_size[1], im_size[0]]
+
+    data = MaskData()
+    for (batch,) in batch_iterator(mask_generator.points_per_batch, pontos):
+        data.cat(
+            mask_generator._process_batch(
+                batch, im_size, crop_box, im_size, normalize=True
+            )
+        )
+
+    if len(data["rles"]) == 0:
+        return []
+
+    keep_by_nms = batched_nms(
+        data["boxes"].float(),
+        data["iou_preds"].float(),
+        torch.zeros_like(data["boxes"][:, 0]),  # categorias
+        iou_threshold=mask_generator.box_nms_thresh,
+    )
+    data.filter(keep_by_nms)
+
+    return [rle_to_mask(rle) for rle in data["rles"]]
+
+
+def _selecionar_imagem(predictor, features, tamanhos, i):
+    """
+    Deixa no preditor apenas as features da i-ésima imagem de um lote
+    codificado com set_image_batch, como se set_image tivesse sido chamado
+    só para ela.
+    """
+    predictor._features = {
+        "image_embed": features["image_embed"][i : i + 1],
+        "high_res_feats": [f[i : i + 1] for f in features["high_res_feats"]],
+    }
+    predictor._orig_hw = [tamanhos[i]]
+    predictor._is_batch = False
+    predictor._is_image_set = True
+
+
+def _ler_patches(tarefas, fila):
+    """
+    Lê os patches em ordem e os coloca na fila como imagens HWC; None indica
+    o fim da leitura.
+    """
+    for image_path, output_path in tarefas:
+        try:
+            with rasterio.open(image_path) as src:
+                image_np = np.ascontiguousarray(
+                    src.read().transpose(1, 2, 0)  # CHW -> HWC
+                )
+            fila.put((image_path, output_path, image_np, None))
+        except Exception as e:
+            fila.put((image_path, output_path, None, e))
+    fila.put(None)
+
+
+def _processar_lote(mask_generator, lote, grades):
+    """
+    Codifica um lote de patches em uma única passada do encoder com
+    set_image_batch e depois gera e salva as máscaras de cada patch a partir
+    das features já calculadas.
+
+    Args:
+        mask_generator: Gerador já configurado.
+        lote: Lista de (image_path, output_path, image_np).
+        grades: Cache das grades de pontos em pixels, por tamanho de patch.
+    """
+    predictor = mask_generator.predictor
+    imagens = [image_np for _, _, image_np in lote]
+    if DEVICE.type == "cuda":
+        # Um último lote menor mudaria o formato de entrada do encoder
+        # compilado (nova compilação e nova captura de CUDA graph); ele é
+        # completado repetindo a última imagem, e as features extras são
+        # ignoradas.
+        imagens += [imagens[-1]] * (TAMANHO_LOTE - len(imagens))
+    with torch.inference_mode(), torch.autocast(
+        device_type=DEVICE.type,
+        dtype=torch.bfloat16,
+        enabled=DEVICE.type == "cuda",
+    ):
+        try:
+            predictor.set_image_batch(imagens)
+        except Exception as e:
+            for image_path, _, _ in lote:
+                print(
+                    f"\nErro ao processar o arquivo "
+                    f"{os.path.basename(image_path)}: {e}"
+                )
+            return
+
+        features = predictor._features
+        tamanhos = predictor._orig_hw
+
+        for i, (image_path, output_path, _) in enumerate(lote):
+            base_name = os.path.basename(image_path)
+            try:
+                im_size = tamanhos[i]
+                if im_size not in grades:
+                    grades[im_size] = (
+                        mask_generator.point_grids[0]
+                        * np.array(im_size)[None, ::-1]
+                    )
+
+                _selecionar_imagem(predictor, features, tamanhos, i)
+                mask_arrays = gerar_mascaras(
+                    mask_generator, im_size, grades[im_size]
+                )
+
+                if not mask_arrays:
+                    continue
+
+                stacked_masks = np.stack(mask_arrays, axis=0)
+
+                # 1 bit por pixel: arquivo ~8x menor e descompressão mais
+                # rápida na etapa 02, que desempacota usando o formato
+                # salvo em 'shape'.
+                np.savez_compressed(
+                    output_path,
+                    masks=np.packbits(stacked_masks, axis=-1),
+                    shape=np.asarray(stacked_masks.shape),
+                )
+
+            except Exception as e:
+                print(f"\nErro ao processar o arquivo {base_name}: {e}")
+                continue
+
+    predictor.reset_predictor()
+
 
 def segmentar_patches_via_hf_id():
     os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -35,15 +190,20 @@ def segmentar_patches_via_hf_id():
             stability_score_offset=1.0,
             mask_threshold=0.0,
             box_nms_thresh=0.6,
-            crop_n_layers=1,
-            crop_nms_thresh=0.6,
-            crop_overlap_ratio=128
-            / 1024,  # 128 pixels de sobreposição em um patch de 1024 pixels
-            crop_n_points_downscale_factor=2,
+            crop_n_layers=0,  # uma única passada do encoder por patch
             min_mask_region_area=150000,  # 150k pixels
             use_m2m=True,
         )
 
+        if DEVICE.type == "cuda":
+            # O preditor redimensiona todo patch para model.image_size
+            # (1024x1024) e todo lote tem TAMANHO_LOTE imagens (ver
+            # _processar_lote), então a entrada do encoder compilado tem
+            # sempre o mesmo formato
+            sam2_model.image_encoder = torch.compile(
+                sam2_model.image_encoder, mode="reduce-overhead"
+            )
+
     except Exception as e:
         print(f"Erro ao carregar ou configurar o modelo: {e}")
         return
@@ -55,32 +215,42 @@ def segmentar_patches_via_hf_id():
 
     print(f"Encontrados {len(image_paths)} patches para processar.")
 
-    for image_path in tqdm(image_paths, desc="Segmentando patches"):
+    tarefas = []
+    for image_path in image_paths:
         base_name = os.path.basename(image_path)
         output_filename = f"{os.path.splitext(base_name)[0]}_masks.npz"
         output_path = os.path.join(OUTPUT_DIR, output_filename)
 
-        if os.path.exists(output_path):
-            continue
-
-        try:
-            with rasterio.open(image_path) as src:
-                image_np = src.read()
-                image_np = np.transpose(image_np, (1, 2, 0))  # CHW -> HWC
+        if not os.path.exists(output_path):
+            tarefas.append((image_path, output_path))
 
-            masks = mask_generator.generate(image_np)
+    # A leitura dos patches roda em uma thread separada, enquanto a GPU
+    # segmenta o lote anterior.
+    fila = queue.Queue(maxsize=2 * TAMANHO_LOTE)
+    threading.Thread(
+        target=_ler_patches, args=(tarefas, fila), daemon=True
+    ).start()
 
-            if not masks:
-                continue
+    grades = {}  # grade de pontos em pixels, por tamanho de patch
 
-            mask_arrays = [mask['segmentation'] for mask in masks]
+    lote = []
+    for image_path, output_path, image_np, erro in tqdm(
+        iter(fila.get, None), total=len(tarefas), desc="Segmentando patches"
+    ):
+        if erro is not None:
+            print(
+                f"\nErro ao processar o arquivo "
+                f"{os.path.basename(image_path)}: {erro}"
+            )
+            continue
 
-            stacked_masks = np.stack(mask_arrays, axis=0)
-            np.savez_compressed(output_path, masks=stacked_masks)
+        lote.append((image_path, output_path, image_np))
+        if len(lote) == TAMANHO_LOTE:
+            _processar_lote(mask_generator, lote, grades)
+            lote = []
 
-        except Exception as e:
-            print(f"\nErro ao processar o arquivo {base_name}: {e}")
-            continue
+    if lote:
+        _processar_lote(mask_generator, lote, grades)
 
     print("\nProcessamento concluído!")
     print(f"Arquivos .npz salvos em: {OUTPUT_DIR}")
@@ -1,21 +1,156 @@
 import numpy as np
 import geopandas as gpd
-from shapely.geometry import Polygon
+import shapely
 from rasterio.features import shapes
 import rasterio
 import os
 import glob
+from concurrent.futures import ProcessPoolExecutor
 import zipfile
 from tqdm import tqdm
 from pathlib import Path
 
+from utils_vetoriais import caminho_no_formato, parse_args_formato
+
 MASKS_DIR = "./dados/mascaras_campo_verde_sam2"
 PATCHES_DIR = "./dados/patches_campo_verde"
 OUTPUT_SHP = "./dados/sam2/campo_verde_mascaras.shp"
 AREA_MIN = 100  # metros quadrados
 
 
-def converter_npz_para_shp():
+def _reparar(geoms):
+    """
+    Repara geometrias inválidas com make_valid, mantendo apenas as partes
+    poligonais quando o resultado é uma GeometryCollection.
+    """
+    reparadas = shapely.make_valid(geoms)
+    colecoes = shapely.get_type_id(reparadas) == 7  # GeometryCollection
+    for k in np.flatnonzero(colecoes):
+        partes = shapely.get_parts(reparadas[k])
+        poligonais = np.isin(shapely.get_type_id(partes), [3, 6])
+        reparadas[k] = shapely.union_all(partes[poligonais])
+    return reparadas
+
+
+def _process_one(npz_path):
+    """
+    Converte as máscaras de um arquivo NPZ em polígonos.
+
+    Executada em um processo separado: as geometrias são devolvidas em WKB
+    para que o resultado possa ser serializado entre processos.
+    """
+    try:
+        npz_name = Path(npz_path).stem
+        if npz_name.endswith('_masks'):
+            patch_name = npz_name[:-6]
+        else:
+            patch_name = npz_name
+
+        patch_path = os.path.join(PATCHES_DIR, f"{patch_name}.tif")
+
+        if not os.path.exists(patch_path):
+            print(f"Patch não encontrado: {patch_path}")
+            return None
+
+        with rasterio.open(patch_path) as src:
+            transform = src.transform
+            crs = src.crs
+
+        data = np.load(npz_path)
+        if 'masks' in data:
+            masks = data['masks']
+        else:
+            masks = data[list(data.keys())[0]]
+
+        # Máscaras gravadas com np.packbits trazem o formato original em
+        # 'shape'; as demais são uint8/bool (N, H, W).
+        largura = int(data['shape'][-1]) if 'shape' in data else None
+        altura = masks.shape[1]
+        mask_binary = np.empty(
+            (altura, largura or masks.shape[2]), dtype=np.uint8
+        )
+
+        # Máscaras que não se sobrepõem são gravadas juntas em uma mesma
+        # imagem de rótulos (valor = mask_id + 1), e shapes() roda uma vez por
+        # camada em vez de uma vez por máscara. Cada máscara vai para a
+        # primeira camada em que não colide com as já gravadas.
+        camadas = []
+        for mask_id in range(masks.shape[0]):
+            if largura is not None:
+                mask_binary[:] = np.unpackbits(
+                    masks[mask_id], axis=-1, count=largura
+                )
+            else:
+                np.copyto(mask_binary, masks[mask_id], casting='unsafe')
+            pixels = mask_binary.view(bool)
+
+            for rotulos in camadas:
+                if not rotulos[pixels].any():
+                    break
+            else:
+                rotulos = np.zeros(mask_binary.shape, dtype=np.int32)
+                camadas.append(rotulos)
+            rotulos[pixels] = mask_id + 1
+
+        # Coordenadas dos anéis externos e atributos, em listas paralelas; os
+        # polígonos são construídos de uma só vez ao final.
+        ring_coords = []
+        mask_ids = []
+        origem = []  # mask_id de cada polígono, para restaurar a ordem
+        n_poligonos = np.zeros(masks.shape[0], dtype=np.int64)
+
+        for rotulos in camadas:
+            for polygon, value in shapes(
+                rotulos, mask=rotulos > 0, transform=transform
+            ):
+                mask_id = int(value) - 1
+                ring_coords.append(np.asarray(polygon['coordinates'][0]))
+                mask_ids.append(
+                    f"{patch_name}_{mask_id}_{n_poligonos[mask_id]}"
+                )
+                origem.append(mask_id)
+                n_poligonos[mask_id] += 1
+
+        if not ring_coords:
+            return None
+
+        # Mesma ordem da versão por máscara: por mask_id, depois pela ordem
+        # de varredura do shapes().
+        ordem = np.argsort(origem, kind='stable')
+        ring_coords = [ring_coords[k] for k in ordem]
+        mask_ids = [mask_ids[k] for k in ordem]
+
+        rings = shapely.linearrings(
+            np.concatenate(ring_coords),
+            indices=np.repeat(
+                np.arange(len(ring_coords)), [len(c) for c in ring_coords]
+            ),
+        )
+        geoms = shapely.polygons(rings)
+
+        # shapes() quase sempre devolve anéis válidos: a validação é feita
+        # em lote e só as geometrias inválidas são reparadas.
+        invalidas = ~shapely.is_valid(geoms)
+        if invalidas.any():
+            geoms[invalidas] = _reparar(geoms[invalidas])
+
+        areas = shapely.area(geoms)
+        keep = areas >= AREA_MIN
+
+        return {
+            'wkb': shapely.to_wkb(geoms[keep]),
+            'mask_id': np.asarray(mask_ids)[keep],
+            'patch_orig': np.full(np.count_nonzero(keep), patch_name),
+            'area_ha': areas[keep] / 10000,
+            'crs': crs.to_wkt() if crs else None,
+        }
+
+    except Exception as e:
+        print(f"Erro ao processar {npz_path}: {e}")
+        return None
+
+
+def converter_npz_para_shp(formato="parquet"):
     if not os.path.exists(MASKS_DIR):
         print(f"Diretório de máscaras não encontrado: {MASKS_DIR}")
         return
@@ -34,86 +169,47 @@ def converter_npz_para_shp():
     todas_geometrias = []
     crs_final = None
 
-    for npz_path in tqdm(npz_files, desc="Processando arquivos NPZ"):
-        try:
-            npz_name = Path(npz_path).stem
-            if npz_name.endswith('_masks'):
-                patch_name = npz_name[:-6]
-            else:
-                patch_name = npz_name
-
-            patch_path = os.path.join(PATCHES_DIR, f"{patch_name}.tif")
-
-            if not os.path.exists(patch_path):
-                print(f"Patch não encontrado: {patch_path}")
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for resultado in tqdm(
+            executor.map(_process_one, npz_files),
+            total=len(npz_files),
+            desc="Processando arquivos NPZ",
+        ):
+            if resultado is None or len(resultado['wkb']) == 0:
                 continue
-
-            with rasterio.open(patch_path) as src:
-                transform = src.transform
-                crs = src.crs
-                if crs_final is None:
-                    crs_final = crs
-
-            data = np.load(npz_path)
-            if 'masks' in data:
-                masks = data['masks']
-            else:
-                masks = data[list(data.keys())[0]]
-
-            for mask_id, mask_array in enumerate(masks):
-                mask_binary = mask_array.astype(np.uint8)
-                polygons = list(
-                    shapes(mask_binary, mask=mask_binary, transform=transform)
-                )
-
-                for i, (polygon, value) in enumerate(polygons):
-                    if value == 1:  # Região da máscara
-                        try:
-                            geom = Polygon(polygon['coordinates'][0])
-
-                            if not geom.is_valid:
-                                geom = geom.buffer(0)
-
-                            if geom.is_valid and geom.area >= AREA_MIN:
-                                todas_geometrias.append(
-                                    {
-                                        'geometry': geom,
-                                        'mask_id': f"{patch_name}_{mask_id}_{i}",
-                                        'patch_orig': patch_name,
-                                        'area_ha': geom.area / 10000,
-                                    }
-                                )
-
-                        except Exception as e:
-                            continue
-
-        except Exception as e:
-            print(f"Erro ao processar {npz_path}: {e}")
-            continue
+            if crs_final is None:
+                crs_final = resultado['crs']
+            todas_geometrias.append(resultado)
 
     if not todas_geometrias:
         print("Nenhuma geometria válida foi gerada!")
         return
 
-    print(f"Total de polígonos gerados: {len(todas_geometrias)}")
-
-    geometries = [g['geometry'] for g in todas_geometrias]
+    geometries = shapely.from_wkb(
+        np.concatenate([g['wkb'] for g in todas_geometrias])
+    )
     attributes = {
-        'mask_id': [g['mask_id'] for g in todas_geometrias],
-        'patch_orig': [g['patch_orig'] for g in todas_geometrias],
-        'area_ha': [g['area_ha'] for g in todas_geometrias],
+        col: np.concatenate([g[col] for g in todas_geometrias])
+        for col in ['mask_id', 'patch_orig', 'area_ha']
     }
 
+    print(f"Total de polígonos gerados: {len(geometries)}")
+
     gdf = gpd.GeoDataFrame(attributes, geometry=geometries, crs=crs_final)
 
-    os.makedirs(os.path.dirname(OUTPUT_SHP), exist_ok=True)
+    output_path = caminho_no_formato(OUTPUT_SHP, formato)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    gdf.to_file(OUTPUT_SHP)
+    if formato == "parquet":
+        gdf.to_parquet(output_path)
+    else:
+        gdf.to_file(output_path)
 
     print(f"Polígonos salvos: {len(gdf)}")
     print(f"Área total: {gdf['area_ha'].sum():.2f} hectares")
     print(f"Área média: {gdf['area_ha'].mean():.2f} hectares")
-    print(f"Shapefile salvo: {OUTPUT_SHP}")
+    print(f"Arquivo vetorial salvo: {output_path}")
+
 
 def zip_files():
     name = OUTPUT_SHP[:-4]
@@ -131,5 +227,13 @@ def zip_files():
 
 
 if __name__ == "__main__":
-    converter_npz_para_shp()
-    zip_files()
+    args = parse_args_formato(
+        "Agrega as máscaras NPZ do SAM2 em um único arquivo vetorial.",
+        (
+            "Formato do arquivo vetorial de saída (padrão: parquet). Com "
+            "'shp', o shapefile também é compactado em .zip."
+        ),
+    )
+    converter_npz_para_shp(args.format)
+    if args.format == "shp":
+        zip_files()
@@ -1,11 +1,24 @@
 import geopandas as gpd
 import rasterio
-from rasterio.mask import mask
+from rasterio.features import rasterize
+from rasterio.windows import Window
 import numpy as np
+import shapely
 import os
 from tqdm import tqdm
 import zipfile
-import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from utils_vetoriais import (
+    camadas_sem_sobreposicao,
+    caminho_no_formato,
+    parse_args_formato,
+)
+
+# Cache de blocos do GDAL maior que o padrão e descompressão em várias
+# threads; precisam ser definidos antes do primeiro rasterio.open.
+os.environ.setdefault("GDAL_CACHEMAX", "512")
+os.environ.setdefault("GDAL_NUM_THREADS", "ALL_CPUS")
 
 CLASSES_MAPBIOMAS_AGRICULTURA = [
     18,  # Agricultura
@@ -22,34 +35,96 @@ CLASSES_MAPBIOMAS_AGRICULTURA = [
     48,  # Outras Culturas Perenes
 ]
 
+# Indexada com o array de classes lido do raster, devolve direto a máscara
+# booleana dos pixels agrícolas
+LUT_AGRICULTURA = np.zeros(256, dtype=bool)
+LUT_AGRICULTURA[CLASSES_MAPBIOMAS_AGRICULTURA] = True
 
-def get_agriculture_coverage(geometry, mapbiomas_raster):
-    """
-    Calcula o percentual de cobertura de classes agrícolas dentro de uma geometria.
+# Altura, em linhas, das faixas do raster processadas em paralelo
+ALTURA_FAIXA = 1024
+
+
+def _contar_faixa(caminho, janela, candidatos, geometrias, camadas):
     """
-    try:
-        with rasterio.open(mapbiomas_raster) as src:
-            out_image, out_transform = mask(
-                src, [geometry], crop=True, filled=True
-            )
+    Conta, para as geometrias que tocam uma faixa do raster, os pixels válidos
+    e agrícolas dentro da faixa.
 
-            if out_image.ndim == 3:
-                out_image = out_image[0]
+    Executada em uma thread do pool: cada faixa usa o seu próprio dataset,
+    já que um dataset do rasterio não pode ser lido por várias threads ao
+    mesmo tempo.
 
-            total_pixels = np.count_nonzero(out_image)
-            if total_pixels == 0:
-                return 0.0
+    Returns:
+        Lista de (índices das geometrias, pixels válidos, pixels agrícolas),
+        uma entrada por camada presente na faixa.
+    """
+    with rasterio.open(caminho) as src:
+        mapbiomas_array = src.read(1, window=janela)
+        transform = src.window_transform(janela)
+
+    pixels_validos = mapbiomas_array != 0
+    pixels_agricolas = LUT_AGRICULTURA[mapbiomas_array]
+
+    contagens = []
+    camadas_candidatos = camadas[candidatos]
+    for camada in np.unique(camadas_candidatos):
+        membros = candidatos[camadas_candidatos == camada]
+        rotulos = rasterize(
+            ((geometrias[k], n + 1) for n, k in enumerate(membros)),
+            out_shape=mapbiomas_array.shape,
+            transform=transform,
+            fill=0,
+            dtype='int32',
+        )
+        minlength = len(membros) + 1
+        contagens.append((
+            membros,
+            np.bincount(rotulos[pixels_validos], minlength=minlength)[1:],
+            np.bincount(rotulos[pixels_agricolas], minlength=minlength)[1:],
+        ))
+    return contagens
 
-            agri_pixels = np.isin(
-                out_image, CLASSES_MAPBIOMAS_AGRICULTURA
-            ).sum()
 
-            return (agri_pixels / total_pixels) * 100
+def get_agriculture_coverage(geometrias, src, max_workers=8):
+    """
+    Calcula o percentual de cobertura de classes agrícolas dentro de cada
+    geometria.
 
-    except Exception as e:
-        if "Input shapes do not overlap raster" not in str(e):
-            print(f"\nAviso ao processar geometria: {e}")
-        return 0.0
+    As geometrias são rasterizadas em lote numa imagem de rótulos e os pixels
+    são contados por rótulo com np.bincount, em vez de uma leitura por
+    geometria. O raster é dividido em faixas horizontais processadas em
+    paralelo; as contagens parciais de cada faixa são somadas.
+    """
+    geometrias = np.asarray(geometrias)
+    camadas = camadas_sem_sobreposicao(geometrias)
+    arvore = shapely.STRtree(geometrias)
+
+    faixas = []
+    for linha in range(0, src.height, ALTURA_FAIXA):
+        janela = Window(
+            0, linha, src.width, min(ALTURA_FAIXA, src.height - linha)
+        )
+        candidatos = arvore.query(shapely.box(*src.window_bounds(janela)))
+        if len(candidatos):
+            faixas.append((janela, np.sort(candidatos)))
+
+    total_pixels = np.zeros(len(geometrias), dtype=np.int64)
+    agri_pixels = np.zeros(len(geometrias), dtype=np.int64)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        resultados = executor.map(
+            lambda faixa: _contar_faixa(
+                src.name, faixa[0], faixa[1], geometrias, camadas
+            ),
+            faixas,
+        )
+        for contagens in tqdm(
+            resultados, total=len(faixas), desc="Analisando cobertura MapBiomas"
+        ):
+            for membros, total, agri in contagens:
+                total_pixels[membros] += total
+                agri_pixels[membros] += agri
+
+    return 100 * agri_pixels / np.maximum(total_pixels, 1)
 
 
 def filtrar_mascaras(
@@ -59,10 +134,14 @@ def filtrar_mascaras(
     area_min_ha,
     area_max_ha,
     agri_pct_min,
+    formato="parquet",
 ):
-    if not os.path.exists(input_shp):
+    input_path = caminho_no_formato(input_shp, formato)
+    output_path = caminho_no_formato(output_shp, formato)
+
+    if not os.path.exists(input_path):
         raise FileNotFoundError(
-            f"Shapefile de entrada não encontrado: {input_shp}"
+            f"Arquivo vetorial de entrada não encontrado: {input_path}"
         )
     if not os.path.exists(mapbiomas_raster):
         raise FileNotFoundError(
@@ -70,7 +149,10 @@ def filtrar_mascaras(
         )
 
     print("Iniciando filtragem de máscaras...")
-    gdf = gpd.read_file(input_shp)
+    if formato == "parquet":
+        gdf = gpd.read_parquet(input_path)
+    else:
+        gdf = gpd.read_file(input_path)
     initial_count = len(gdf)
     print(f"   - Polígonos iniciais: {initial_count}")
 
@@ -87,14 +169,9 @@ def filtrar_mascaras(
         if gdf_filtrado.crs != src.crs:
             gdf_filtrado = gdf_filtrado.to_crs(src.crs)
 
-    coberturas = list()
-    for geom in tqdm(
-        gdf_filtrado.geometry, desc="Analisando cobertura MapBiomas"
-    ):
-        cobertura = get_agriculture_coverage(geom, mapbiomas_raster)
-        coberturas.append(cobertura)
-
-    gdf_filtrado['agri_pct'] = coberturas
+        gdf_filtrado['agri_pct'] = get_agriculture_coverage(
+            gdf_filtrado.geometry, src
+        )
 
     gdf_final = gdf_filtrado[gdf_filtrado['agri_pct'] >= agri_pct_min].copy()
     count_after_mapbiomas = len(gdf_final)
@@ -103,11 +180,23 @@ def filtrar_mascaras(
     if gdf_final.empty:
         return
 
-    os.makedirs(os.path.dirname(output_shp), exist_ok=True)
-    gdf_final.to_file(output_shp)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if formato == "parquet":
+        gdf_final.to_parquet(output_path)
+    else:
+        gdf_final.to_file(output_path)
 
 
 def main():
+    args = parse_args_formato(
+        "Filtra as máscaras segmentadas por área e cobertura agrícola do MapBiomas.",
+        (
+            "Formato dos arquivos vetoriais de entrada e saída (padrão: "
+            "parquet). Com 'shp', o shapefile de saída também é compactado "
+            "em .zip."
+        ),
+    )
+
     INPUT_SHP = "./dados/sam2/campo_verde_mascaras.shp"
     OUTPUT_SHP_FILTRADO = "./dados/sam2/campo_verde_mascaras_filtradas.shp"
     MAPBIOMAS_RASTER = "./dados/mapbiomas_campo_verde.tif"
@@ -125,8 +214,12 @@ def main():
         area_min_ha=AREA_MIN_HA,
         area_max_ha=AREA_MAX_HA,
         agri_pct_min=AGRI_PCT_MIN,
+        formato=args.format,
     )
 
+    if args.format != "shp":
+        return
+
     name = OUTPUT_SHP_FILTRADO[:-4]
 
     for ext in ['.shp', '.shx', '.dbf', '.prj', '.cpg']:
@@ -1,10 +1,27 @@
 import geopandas as gpd
 import rasterio
-from rasterio.mask import mask
+from rasterio.features import geometry_mask, geometry_window, rasterize
+from rasterio.windows import Window, union
 import numpy as np
+import shapely
+from numba import njit, prange
+import atexit
 import os
+from collections import defaultdict
 from tqdm import tqdm
 import zipfile
+from functools import lru_cache
+
+from utils_vetoriais import (
+    camadas_sem_sobreposicao,
+    caminho_no_formato,
+    parse_args_formato,
+)
+
+# Cache de blocos do GDAL maior que o padrão: as janelas dos talhões vizinhos
+# se repetem e passam a ser servidas da memória. Precisa ser definido antes
+# do primeiro rasterio.open.
+os.environ.setdefault("GDAL_CACHEMAX", "512")
 
 INPUT_SHP = "./dados/sam2/campo_verde_mascaras_filtradas.shp"
 IMAGEM_RASTER = "./dados/campo_verde_merged_clip.tif"
@@ -13,65 +30,326 @@ OUTPUT_SHP = "./dados/sam2/campo_verde_talhoes_com_heterogeneidade.shp"
 BANDA_VERMELHO = 3
 BANDA_NIR = 1
 
+# Talhões são agrupados pela célula de TAMANHO_BLOCO x TAMANHO_BLOCO pixels
+# onde começa a sua janela; a leitura de cada grupo cobre no máximo o dobro
+# disso. Talhões maiores que o bloco são lidos individualmente.
+TAMANHO_BLOCO = 2048
+
+
+def _percentis(valores, qs):
+    """
+    Percentis com interpolação linear (mesmo resultado de np.percentile),
+    usando np.partition em O(N) no lugar da ordenação completa.
+    """
+    posicoes = [q / 100 * (valores.size - 1) for q in qs]
+    kth = sorted(
+        {int(np.floor(p)) for p in posicoes}
+        | {int(np.ceil(p)) for p in posicoes}
+    )
+    parcial = np.partition(valores, kth)
+    resultado = []
+    for p in posicoes:
+        baixo, alto = parcial[int(np.floor(p))], parcial[int(np.ceil(p))]
+        resultado.append(baixo + (alto - baixo) * (p - np.floor(p)))
+    return resultado
+
+
+def _resumir_ndvi(n, soma, soma_quadrados, pixels_validos):
+    if n < 10:
+        return None
+
+    media = soma / n
+    desvio = np.sqrt(max(soma_quadrados / n - media**2, 0))
+    p10, p90 = _percentis(pixels_validos, (10, 90))
+
+    return {
+        'ndvi_mean': media,
+        'ndvi_std': desvio,
+        'ndvi_cv': (desvio / media) * 100 if media != 0 else 0,
+        'ndvi_p10': p10,
+        'ndvi_p90': p90,
+    }
+
+
+# Sem as flags nnan/ninf: o fastmath completo permitiria ao compilador
+# descartar os testes de NaN/infinito usados para validar cada pixel. Os
+# kernels que contam e os que copiam os pixels válidos usam as mesmas flags,
+# para concordarem sobre quais pixels são válidos.
+FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+
+@njit(inline="always")
+def _ndvi_pixel(r, v, nodata):
+    """NDVI de um pixel, ou NaN se o pixel for nodata ou o valor inválido."""
+    r = np.float64(r)
+    v = np.float64(v)
+    if r == nodata or v == nodata:
+        return np.nan
+    x = (v - r) / (v + r + 1e-6)
+    if not np.isfinite(x) or x < -1.0 or x > 1.0:
+        return np.nan
+    return x
+
+
+@njit(parallel=True, fastmath=FASTMATH, cache=True)
+def _ndvi_reduzir(red, nir, nodata):
+    """
+    Contagem, soma e soma dos quadrados do NDVI dos pixels válidos, em uma
+    única passada sem arrays temporários.
+    """
+    n = 0
+    soma = 0.0
+    soma_quadrados = 0.0
+    for i in prange(red.size):
+        x = _ndvi_pixel(red[i], nir[i], nodata)
+        if np.isnan(x):
+            continue
+        n += 1
+        soma += x
+        soma_quadrados += x * x
+    return n, soma, soma_quadrados
 
-def calcular_ndvi_stats(geometry, raster_path):
+
+@njit(fastmath=FASTMATH, cache=True)
+def _ndvi_compactar(red, nir, nodata, saida):
+    """
+    Copia o NDVI dos pixels válidos, em ordem, para `saida` (sem passar do
+    seu tamanho) e devolve quantos foram copiados.
+    """
+    k = 0
+    for i in range(red.size):
+        if k == saida.size:
+            break
+        x = _ndvi_pixel(red[i], nir[i], nodata)
+        if not np.isnan(x):
+            saida[k] = x
+            k += 1
+    return k
+
+
+@njit(fastmath=FASTMATH, cache=True)
+def _reduzir_por_rotulo(rotulos, red, nir, nodata, n_rotulos):
+    """
+    Uma passada sobre o bloco acumulando, por rótulo, a contagem, a soma e a
+    soma dos quadrados do NDVI dos pixels válidos.
+    """
+    contagem = np.zeros(n_rotulos + 1, dtype=np.int64)
+    soma = np.zeros(n_rotulos + 1, dtype=np.float64)
+    soma_quadrados = np.zeros(n_rotulos + 1, dtype=np.float64)
+
+    for i in range(rotulos.shape[0]):
+        for j in range(rotulos.shape[1]):
+            rotulo = rotulos[i, j]
+            if rotulo == 0:
+                continue
+            x = _ndvi_pixel(red[i, j], nir[i, j], nodata)
+            if np.isnan(x):
+                continue
+            contagem[rotulo] += 1
+            soma[rotulo] += x
+            soma_quadrados[rotulo] += x * x
+
+    return contagem, soma, soma_quadrados
+
+
+@njit(fastmath=FASTMATH, cache=True)
+def _agrupar_por_rotulo(rotulos, red, nir, nodata, inicio):
+    """
+    Segunda passada: copia o NDVI dos pixels válidos para um único buffer,
+    contíguo por rótulo (rótulo k ocupa inicio[k]:inicio[k + 1]).
+    """
+    posicao = inicio[:-1].copy()
+    saida = np.empty(inicio[-1], dtype=np.float64)
+
+    for i in range(rotulos.shape[0]):
+        for j in range(rotulos.shape[1]):
+            rotulo = rotulos[i, j]
+            if rotulo == 0:
+                continue
+            x = _ndvi_pixel(red[i, j], nir[i, j], nodata)
+            if np.isnan(x):
+                continue
+            saida[posicao[rotulo]] = x
+            posicao[rotulo] += 1
+
+    return saida
+
+
+@lru_cache(maxsize=4)
+def _abrir_raster(caminho):
+    """
+    Abre o raster uma única vez por caminho; os datasets são fechados ao
+    final do programa.
+    """
+    src = rasterio.open(caminho)
+    atexit.register(src.close)
+    return src
+
+
+def _nodata(src):
+    return np.nan if src.nodata is None else float(src.nodata)
+
+
+def calcular_ndvi_stats(geometry, src):
     try:
-        with rasterio.open(raster_path) as src:
-            out_image, _ = mask(src, [geometry], crop=True, filled=False)
-
-            if out_image.size == 0 or out_image[0].size == 0:
-                return None
-
-            red = out_image[BANDA_VERMELHO - 1].astype(np.float32)
-            nir = out_image[BANDA_NIR - 1].astype(np.float32)
-
-            ndvi = np.ma.masked_invalid((nir - red) / (nir + red + 1e-6))
-
-            pixels_validos = ndvi[
-                ~ndvi.mask & (ndvi >= -1) & (ndvi <= 1)
-            ].compressed()
-
-            if pixels_validos.size < 10:
-                return None
-            stats = {
-                'ndvi_mean': np.mean(pixels_validos),
-                'ndvi_std': np.std(pixels_validos),
-                'ndvi_cv': (
-                    (np.std(pixels_validos) / np.mean(pixels_validos)) * 100
-                    if np.mean(pixels_validos) != 0
-                    else 0
-                ),
-                'ndvi_p10': np.percentile(pixels_validos, 10),
-                'ndvi_p90': np.percentile(pixels_validos, 90),
-            }
-            return stats
+        window = geometry_window(src, [geometry])
+        red, nir = src.read([BANDA_VERMELHO, BANDA_NIR], window=window)
+
+        if red.size == 0:
+            return None
+
+        dentro = geometry_mask(
+            [geometry],
+            out_shape=red.shape,
+            transform=src.window_transform(window),
+            invert=True,
+        )
+        red = red[dentro]
+        nir = nir[dentro]
+
+        nodata = _nodata(src)
+        n, soma, soma_quadrados = _ndvi_reduzir(red, nir, nodata)
+        pixels_validos = np.empty(n, dtype=np.float64)
+        k = _ndvi_compactar(red, nir, nodata, pixels_validos)
+
+        return _resumir_ndvi(n, soma, soma_quadrados, pixels_validos[:k])
 
     except Exception:
         return None
 
 
+def _janelas_em_pixels(geometrias, src):
+    """
+    Equivalente vetorizado de geometry_window para um array de geometrias:
+    os limites de cada geometria são levados para linhas/colunas do raster
+    (floor no início, ceil no fim) e recortados à extensão do raster.
+
+    Returns:
+        (linhas, colunas, dentro): arrays (N, 2) de [início, fim) e a máscara
+        dos talhões com janela não vazia (exclui geometrias vazias e fora
+        do raster).
+    """
+    xmin, ymin, xmax, ymax = shapely.bounds(geometrias).T
+    inversa = ~src.transform
+    cantos_x = np.stack([xmin, xmax, xmax, xmin])
+    cantos_y = np.stack([ymax, ymax, ymin, ymin])
+    col = inversa.a * cantos_x + inversa.b * cantos_y + inversa.c
+    lin = inversa.d * cantos_x + inversa.e * cantos_y + inversa.f
+
+    with np.errstate(invalid="ignore"):  # geometrias vazias têm limites NaN
+        linhas = np.stack(
+            [np.floor(lin.min(axis=0)), np.ceil(lin.max(axis=0))], axis=1
+        )
+        colunas = np.stack(
+            [np.floor(col.min(axis=0)), np.ceil(col.max(axis=0))], axis=1
+        )
+        dentro = (
+            (linhas[:, 1] > 0)
+            & (linhas[:, 0] < src.height)
+            & (colunas[:, 1] > 0)
+            & (colunas[:, 0] < src.width)
+        )
+
+    linhas = np.clip(np.nan_to_num(linhas), 0, src.height).astype(np.int64)
+    colunas = np.clip(np.nan_to_num(colunas), 0, src.width).astype(np.int64)
+    return linhas, colunas, dentro
+
+
+def calcular_ndvi_stats_em_blocos(geometrias, src):
+    """
+    Calcula as estatísticas NDVI de todos os talhões lendo o raster uma vez
+    por bloco, em vez de uma leitura por talhão.
+
+    Returns:
+        Lista de dicionários (ou None) na mesma ordem de `geometrias`.
+    """
+    geometrias = np.asarray(geometrias)
+    stats_list = [None] * len(geometrias)
+    nodata = _nodata(src)
+
+    # Janelas de todos os talhões de uma vez, a partir dos limites
+    linhas, colunas, dentro = _janelas_em_pixels(geometrias, src)
+    alturas = linhas[:, 1] - linhas[:, 0]
+    larguras = colunas[:, 1] - colunas[:, 0]
+    grandes = (alturas > TAMANHO_BLOCO) | (larguras > TAMANHO_BLOCO)
+
+    for i in np.flatnonzero(dentro & grandes):
+        stats_list[i] = calcular_ndvi_stats(geometrias[i], src)
+
+    grupos = defaultdict(list)
+    janelas = {}
+    for i in np.flatnonzero(dentro & ~grandes).tolist():
+        linha, coluna = int(linhas[i, 0]), int(colunas[i, 0])
+        janelas[i] = Window(coluna, linha, int(larguras[i]), int(alturas[i]))
+        grupos[(linha // TAMANHO_BLOCO, coluna // TAMANHO_BLOCO)].append(i)
+
+    for indices in tqdm(grupos.values(), desc="Analisando blocos"):
+        bloco = union(*[janelas[i] for i in indices])
+        red, nir = src.read([BANDA_VERMELHO, BANDA_NIR], window=bloco)
+        transform_bloco = src.window_transform(bloco)
+
+        geoms_bloco = geometrias[indices]
+        camadas = camadas_sem_sobreposicao(geoms_bloco)
+        for camada in range(camadas.max() + 1):
+            membros = np.flatnonzero(camadas == camada)
+            rotulos = rasterize(
+                ((geoms_bloco[k], n + 1) for n, k in enumerate(membros)),
+                out_shape=red.shape,
+                transform=transform_bloco,
+                fill=0,
+                dtype='int32',
+            )
+
+            contagem, soma, soma_quadrados = _reduzir_por_rotulo(
+                rotulos, red, nir, nodata, len(membros)
+            )
+            inicio = np.zeros(len(membros) + 2, dtype=np.int64)
+            np.cumsum(contagem, out=inicio[1:])
+            pixels = _agrupar_por_rotulo(rotulos, red, nir, nodata, inicio)
+
+            for n, k in enumerate(membros):
+                rotulo = n + 1
+                stats_list[indices[k]] = _resumir_ndvi(
+                    contagem[rotulo],
+                    soma[rotulo],
+                    soma_quadrados[rotulo],
+                    pixels[inicio[rotulo] : inicio[rotulo + 1]],
+                )
+
+    return stats_list
+
+
 def main():
-    if not os.path.exists(INPUT_SHP) or not os.path.exists(IMAGEM_RASTER):
+    args = parse_args_formato(
+        "Calcula estatísticas de NDVI para cada talhão filtrado.",
+        (
+            "Formato dos arquivos vetoriais de entrada e saída (padrão: "
+            "parquet). Com 'shp', o shapefile de saída também é compactado "
+            "em .zip."
+        ),
+    )
+    input_path = caminho_no_formato(INPUT_SHP, args.format)
+    output_path = caminho_no_formato(OUTPUT_SHP, args.format)
+
+    if not os.path.exists(input_path) or not os.path.exists(IMAGEM_RASTER):
         print(
-            "Arquivo de entrada (SHP ou TIF) não encontrado. Verifique os caminhos."
+            "Arquivo de entrada (vetorial ou TIF) não encontrado. Verifique os caminhos."
         )
         return
 
-    gdf = gpd.read_file(INPUT_SHP)
-
-    with rasterio.open(IMAGEM_RASTER) as src:
-        if gdf.crs != src.crs:
-            gdf = gdf.to_crs(src.crs)
+    if args.format == "parquet":
+        gdf = gpd.read_parquet(input_path)
+    else:
+        gdf = gpd.read_file(input_path)
 
     print(
         f"Processando {len(gdf)} talhões para calcular estatísticas NDVI..."
     )
-    stats_list = [
-        calcular_ndvi_stats(row.geometry, IMAGEM_RASTER)
-        for _, row in tqdm(
-            gdf.iterrows(), total=gdf.shape[0], desc="Analisando talhões"
-        )
-    ]
+    src = _abrir_raster(IMAGEM_RASTER)
+    if gdf.crs != src.crs:
+        gdf = gdf.to_crs(src.crs)
+
+    stats_list = calcular_ndvi_stats_em_blocos(gdf.geometry.values, src)
 
     stats_df = gpd.GeoDataFrame(stats_list, index=gdf.index)
     gdf = gdf.join(stats_df)
@@ -97,11 +375,17 @@ def main():
     ]
     print(gdf[colunas_stats].describe().round(3))
 
-    gdf.to_file(OUTPUT_SHP)
+    if args.format == "parquet":
+        gdf.to_parquet(output_path)
+    else:
+        gdf.to_file(output_path)
     print(
-        f"\nShapefile com análise de heterogeneidade salvo em: {OUTPUT_SHP}"
+        f"\nArquivo com análise de heterogeneidade salvo em: {output_path}"
     )
 
+    if args.format != "shp":
+        return
+
     for ext in ['.shp', '.shx', '.dbf', '.prj', '.cpg']:
         file_path = f"{OUTPUT_SHP[:-4]}{ext}"
         if not os.path.exists(file_path):
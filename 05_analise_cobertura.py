@@ -1,9 +1,17 @@
 import geopandas as gpd
 import rasterio
-from rasterio.mask import mask
-from rasterio.features import rasterize
+from rasterio.errors import WindowError
+from rasterio.features import geometry_window, rasterize
+from rasterio.windows import Window
 import numpy as np
+import shapely
+from numba import njit, prange
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from utils_vetoriais import caminho_no_formato, parse_args_formato
 
 CLASSES_MAPBIOMAS_AGRICULTURA = [
     18,  # Agricultura
@@ -20,21 +28,114 @@ CLASSES_MAPBIOMAS_AGRICULTURA = [
     48,  # Outras Culturas Perenes
 ]
 
+# 1 para as classes agrícolas e 0 para as demais: _contar_pixels soma a
+# entrada de cada pixel para obter a contagem agrícola
+LUT_AGRICULTURA = np.zeros(256, dtype=np.uint8)
+LUT_AGRICULTURA[CLASSES_MAPBIOMAS_AGRICULTURA] = 1
+
+# O raster é processado em blocos de TAMANHO_BLOCO x TAMANHO_BLOCO pixels
+TAMANHO_BLOCO = 2048
+
+# Cache de blocos do GDAL e cache de leituras HTTP, para rasters remotos (COG)
+OPCOES_GDAL = dict(
+    GDAL_CACHEMAX=512,
+    VSI_CACHE=True,
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS=".tif",
+)
 
-def get_pixel_area_m2(src: rasterio.io.DatasetReader) -> float:
-    pixel_area_m2 = abs(src.res[0] * src.res[1])
 
-    if src.crs.is_geographic:
-        lat_centro = (src.bounds.bottom + src.bounds.top) / 2
+@lru_cache(maxsize=8)
+def _area_pixel_m2(geografico: bool, res: tuple, bounds: tuple) -> float:
+    pixel_area_m2 = abs(res[0] * res[1])
+
+    if geografico:
+        _, bottom, _, top = bounds
+        lat_centro = (bottom + top) / 2
         fator_correcao = np.cos(np.radians(lat_centro))
         metros_por_grau = 111320  # Valor médio
 
         pixel_area_m2 = abs(
-            (src.res[0] * metros_por_grau * fator_correcao)
-            * (src.res[1] * metros_por_grau)
+            (res[0] * metros_por_grau * fator_correcao)
+            * (res[1] * metros_por_grau)
         )
 
-    return pixel_area_m2
+    return float(pixel_area_m2)
+
+
+def get_pixel_area_m2(src: rasterio.io.DatasetReader) -> float:
+    """Área de um pixel em m², calculada uma vez por grade de raster."""
+    return _area_pixel_m2(
+        src.crs.is_geographic, tuple(src.res), tuple(src.bounds)
+    )
+
+
+def _janelas_em_blocos(src, extensao=None, tamanho=TAMANHO_BLOCO):
+    """
+    Divide a extensão do raster (ou a janela `extensao`, se dada) em janelas
+    de até tamanho x tamanho.
+    """
+    if extensao is None:
+        extensao = Window(0, 0, src.width, src.height)
+    linha_ini, coluna_ini = int(extensao.row_off), int(extensao.col_off)
+    linha_fim = linha_ini + int(extensao.height)
+    coluna_fim = coluna_ini + int(extensao.width)
+
+    for linha in range(linha_ini, linha_fim, tamanho):
+        for coluna in range(coluna_ini, coluna_fim, tamanho):
+            yield Window(
+                coluna,
+                linha,
+                min(tamanho, coluna_fim - coluna),
+                min(tamanho, linha_fim - linha),
+            )
+
+
+def _ler_janela(caminho, janela):
+    """
+    Lê uma janela da banda 1 com um dataset próprio: datasets do rasterio
+    não podem ser compartilhados entre threads.
+    """
+    with rasterio.Env(**OPCOES_GDAL), rasterio.open(caminho) as src:
+        return src.read(1, window=janela)
+
+
+def _ler_blocos(caminho, janelas, max_workers=4):
+    """
+    Lê as janelas em paralelo e as devolve na ordem dada, enquanto o bloco
+    anterior é processado. No máximo 2 * max_workers blocos ficam em memória.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pendentes = deque()
+        for janela in janelas:
+            pendentes.append(executor.submit(_ler_janela, caminho, janela))
+            if len(pendentes) >= 2 * max_workers:
+                yield pendentes.popleft().result()
+        while pendentes:
+            yield pendentes.popleft().result()
+
+
+@njit(parallel=True, cache=True, boundscheck=False)
+def _contar_pixels(mascara, mb, lut):
+    """
+    Conta, em uma única passada, os pixels da máscara (segmentação ou AOI) e
+    os que, dentre eles, são agricultura no MapBiomas, sem máscaras
+    intermediárias.
+
+    As linhas são divididas entre as threads; cada linha acumula em
+    contadores locais e só o total da linha entra na redução.
+    """
+    total = 0
+    agricolas = 0
+    for i in prange(mascara.shape[0]):
+        total_linha = 0
+        agricolas_linha = 0
+        for j in range(mascara.shape[1]):
+            if mascara[i, j]:
+                total_linha += 1
+                agricolas_linha += lut[mb[i, j]]
+        total += total_linha
+        agricolas += agricolas_linha
+    return total, agricolas
 
 
 def calcular_area_agricola_total(
@@ -46,15 +147,44 @@ def calcular_area_agricola_total(
         if aoi_gdf.crs != src.crs:
             aoi_gdf = aoi_gdf.to_crs(src.crs)
 
+        # Mesma janela que mask(crop=True) recortaria, percorrida em blocos;
+        # a AOI é rasterizada em cada bloco no lugar do mascaramento.
         try:
-            out_image, _ = mask(src, aoi_gdf.geometry, crop=True)
-        except ValueError:
+            janela_aoi = geometry_window(src, aoi_gdf.geometry)
+        except WindowError:
             return 0
 
+        # Só os blocos que a AOI toca são lidos
+        aoi = shapely.union_all(aoi_gdf.geometry.values)
+        shapely.prepare(aoi)
+        janelas = [
+            janela
+            for janela in _janelas_em_blocos(src, janela_aoi)
+            if aoi.intersects(shapely.box(*src.window_bounds(janela)))
+        ]
+
+        # Pares (geometria, valor) montados uma vez, direto do array de
+        # geometrias, em vez de iterar a GeoSeries a cada bloco
+        formas_aoi = [(geom, 1) for geom in aoi_gdf.geometry.values]
+
+        agri_pixel_count = 0
+        for janela, mapbiomas_array in zip(
+            janelas, _ler_blocos(mapbiomas_raster_path, janelas)
+        ):
+            mascara_aoi = rasterize(
+                formas_aoi,
+                out_shape=(int(janela.height), int(janela.width)),
+                transform=src.window_transform(janela),
+                fill=0,
+                all_touched=False,
+                dtype='uint8',
+            )
+            _, agricolas = _contar_pixels(
+                mascara_aoi, mapbiomas_array, LUT_AGRICULTURA
+            )
+            agri_pixel_count += agricolas
+
         pixel_area_m2 = get_pixel_area_m2(src)
-        agri_pixel_count = np.isin(
-            out_image, CLASSES_MAPBIOMAS_AGRICULTURA
-        ).sum()
 
         return (agri_pixel_count * pixel_area_m2) / 10000
 
@@ -64,32 +194,67 @@ def calcular_metricas_segmentacao(
     mapbiomas_raster_path: str,
     area_total_agricola_ha: float,
 ) -> dict:
-    gdf_filtrado = gpd.read_file(filtered_shp_path)
+    if filtered_shp_path.endswith(".parquet"):
+        gdf_filtrado = gpd.read_parquet(filtered_shp_path)
+    else:
+        gdf_filtrado = gpd.read_file(filtered_shp_path)
 
     with rasterio.open(mapbiomas_raster_path) as src:
         if gdf_filtrado.crs != src.crs:
             gdf_filtrado = gdf_filtrado.to_crs(src.crs)
 
-        mapbiomas_array = src.read(1)
-        mascara_referencia_agri = np.isin(
-            mapbiomas_array, CLASSES_MAPBIOMAS_AGRICULTURA
+        # Só as geometrias que tocam o raster seguem para a rasterização
+        no_raster = gdf_filtrado.sindex.query(
+            shapely.box(*src.bounds), predicate="intersects"
         )
+        gdf_filtrado = gdf_filtrado.iloc[no_raster]
 
-        geometries = gdf_filtrado.geometry
-        mascara_segmentacao = rasterize(
-            geometries,
-            out_shape=mapbiomas_array.shape,
-            transform=src.transform,
-            fill=0,
-            dtype='uint8',
-        ).astype(bool)
+        # A máscara de segmentação é binária: os polígonos são unidos antes
+        # (sobreposições viram um único contorno, com menos arestas para o
+        # rasterize) e separados de novo em partes disjuntas, para que o
+        # índice espacial continue filtrando por bloco.
+        geometries = shapely.get_parts(
+            shapely.union_all(gdf_filtrado.geometry.values)
+        )
+        arvore = shapely.STRtree(geometries)
+
+        # O raster é lido e rasterizado bloco a bloco; só as contagens são
+        # acumuladas, e as geometrias são pré-filtradas pelo índice espacial.
+        blocos = []
+        for janela in _janelas_em_blocos(src):
+            candidatos = arvore.query(
+                shapely.box(*src.window_bounds(janela)),
+                predicate="intersects",
+            )
+            if len(candidatos):
+                blocos.append((janela, candidatos))
+
+        pixels_segmentados = 0
+        pixels_corretos = 0
+
+        for (janela, candidatos), mapbiomas_array in zip(
+            blocos,
+            _ler_blocos(mapbiomas_raster_path, [janela for janela, _ in blocos]),
+        ):
+            mascara_segmentacao = rasterize(
+                ((geom, 1) for geom in geometries[candidatos]),
+                out_shape=mapbiomas_array.shape,
+                transform=src.window_transform(janela),
+                fill=0,
+                all_touched=False,
+                dtype='uint8',
+            )
 
-        interseccao = mascara_segmentacao & mascara_referencia_agri
+            total, corretos = _contar_pixels(
+                mascara_segmentacao, mapbiomas_array, LUT_AGRICULTURA
+            )
+            pixels_segmentados += total
+            pixels_corretos += corretos
 
         pixel_area_ha = get_pixel_area_m2(src) / 10000
 
-        area_segmentada_corretamente_ha = np.sum(interseccao) * pixel_area_ha
-        area_total_segmentada_ha = np.sum(mascara_segmentacao) * pixel_area_ha
+        area_segmentada_corretamente_ha = pixels_corretos * pixel_area_ha
+        area_total_segmentada_ha = pixels_segmentados * pixel_area_ha
 
     recall = (
         (area_segmentada_corretamente_ha / area_total_agricola_ha) * 100
@@ -106,8 +271,18 @@ def calcular_metricas_segmentacao(
 
 
 def main():
+    args = parse_args_formato(
+        "Avalia recall e precisão da segmentação contra o MapBiomas.",
+        (
+            "Formato do arquivo vetorial de máscaras filtradas (padrão: "
+            "parquet)."
+        ),
+    )
+
     AOI_SHP = "./dados/campo_verde.geojson"
-    FILTERED_SHP = "./dados/sam2/campo_verde_mascaras_filtradas.shp"
+    FILTERED_SHP = caminho_no_formato(
+        "./dados/sam2/campo_verde_mascaras_filtradas.shp", args.format
+    )
     MAPBIOMAS_RASTER = "./dados/mapbiomas_campo_verde.tif"
 
     print("Iniciando análise de cobertura da segmentação...")
@@ -6,21 +6,37 @@ Fornece funções para consumir a API STAC do BDC usando pystac-client, baixar a
 satélite e processar imagens, além de obter geometrias de estados e municípios brasileiros via geobr.
 """
 
-import zipfile
+from pystac import Collection
 from pystac_client.item_search import Item
 from pystac_client import Client
 import geopandas as gpd
 from geobr import read_state, read_municipality
-from urllib.request import urlretrieve
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from stream_unzip import stream_unzip
 from datetime import datetime, timedelta
-from typing import Iterator, List, Dict, Optional, Union
+from typing import Iterator, List, Dict, Optional, Tuple, Union
 import os
+import time
 from pathlib import Path
+import numpy as np
 import rasterio
-from rasterio.mask import mask
+import shapely
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.windows import Window
 import concurrent.futures
+from contextlib import ExitStack
+from functools import lru_cache
 
 BDC_API_URL = "https://data.inpe.br/bdc/stac/v1"  # URL base da API STAC do BDC
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB por leitura do corpo da resposta
+COLLECTIONS_CACHE_TTL = 300  # segundos de validade da lista de coleções
+
+# Metadados das coleções já consultadas, por (URL da API, ID da coleção), e
+# a lista de coleções por URL da API, com o instante da consulta
+_collection_cache: Dict[Tuple[str, str], Collection] = {}
+_collections_list_cache: Dict[str, Tuple[float, List[str]]] = {}
 
 
 def get_state_data(
@@ -82,6 +98,44 @@ def get_stac_client(url: Optional[str] = None) -> Client:
     return Client.open(url or BDC_API_URL)
 
 
+@lru_cache(maxsize=None)
+def _default_client() -> Client:
+    """
+    Cliente da API do BDC compartilhado pelas funções quando nenhum cliente é
+    informado; o catálogo é aberto uma única vez por processo.
+    """
+    return get_stac_client()
+
+
+def _client_url(client: Optional[Client]) -> str:
+    """URL da API STAC do cliente, usada como chave dos caches."""
+    return (client.get_self_href() if client else None) or BDC_API_URL
+
+
+def _get_collection(
+    collection_id: str, client: Optional[Client] = None
+) -> Collection:
+    """
+    Retorna a coleção, consultando a API apenas na primeira vez para cada
+    par (API, coleção) no processo.
+
+    Args:
+        collection_id: ID da coleção.
+        client: Cliente STAC configurado (opcional).
+
+    Returns:
+        Objeto Collection.
+    """
+    key = (_client_url(client), collection_id)
+    col = _collection_cache.get(key)
+    if col is None:
+        if client is None:
+            client = _default_client()
+        col = client.get_collection(collection_id)
+        _collection_cache[key] = col
+    return col
+
+
 def get_available_collections(client: Optional[Client] = None) -> List[str]:
     """
     Retorna os IDs de todas as coleções disponíveis na API STAC.
@@ -97,9 +151,19 @@ def get_available_collections(client: Optional[Client] = None) -> List[str]:
         >>> client = get_stac_client()
         >>> get_available_collections(client)
     """
+    url = _client_url(client)
+    cached = _collections_list_cache.get(url)
+    if (
+        cached is not None
+        and time.monotonic() - cached[0] < COLLECTIONS_CACHE_TTL
+    ):
+        return list(cached[1])
+
     if client is None:
-        client = get_stac_client()
-    return [col.id for col in client.get_collections()]
+        client = _default_client()
+    ids = [col.id for col in client.get_collections()]
+    _collections_list_cache[url] = (time.monotonic(), ids)
+    return list(ids)
 
 
 def get_collection_metadata(
@@ -118,9 +182,7 @@ def get_collection_metadata(
     Exemplo:
         >>> get_collection_metadata('CBERS4_MUX')
     """
-    if client is None:
-        client = get_stac_client()
-    col = client.get_collection(collection_id)
+    col = _get_collection(collection_id, client)
     return {
         "id": col.id,
         "title": col.title,
@@ -149,9 +211,7 @@ def get_collection_assets_metadata(
     Exemplo:
         >>> get_collection_assets_metadata('CBERS4_MUX')
     """
-    if client is None:
-        client = get_stac_client()
-    col = client.get_collection(collection_id)
+    col = _get_collection(collection_id, client)
     meta: Dict[str, Dict] = {}
     for key, asset in col.item_assets.items():
         meta[key] = {
@@ -180,9 +240,7 @@ def get_collection_items(
         >>> for item in get_collection_items('CBERS4_MUX'):
         ...     print(item.id)
     """
-    if client is None:
-        client = get_stac_client()
-    return client.get_collection(collection_id).get_items()
+    return _get_collection(collection_id, client).get_items()
 
 
 def get_collection_available_dates(
@@ -205,7 +263,7 @@ def get_collection_available_dates(
         >>> get_collection_available_dates('CBERS4_MUX')
     """
     if client is None:
-        client = get_stac_client()
+        client = _default_client()
     items = get_collection_items(collection_id, client)
     try:
         first = next(items)
@@ -219,12 +277,15 @@ def get_collection_available_dates(
         fields={"include": ["properties.datetime"]},
         sortby=[{"field": "properties.datetime", "direction": "asc"}],
     )
-    dates = {
-        datetime.fromisoformat(item.properties["datetime"])
-        for item in search.items()
-        if item.properties.get("datetime")
+    # Guarda as strings ISO como vêm da API (sem montar objetos Item) e só
+    # converte as strings distintas; a deduplicação final é feita sobre as
+    # datas, já que o mesmo instante pode vir escrito de formas diferentes
+    iso_dates = {
+        item["properties"]["datetime"]
+        for item in search.items_as_dicts()
+        if item.get("properties", {}).get("datetime")
     }
-    return sorted(dates)
+    return sorted({datetime.fromisoformat(d) for d in iso_dates})
 
 
 def search_stac_items(
@@ -259,7 +320,7 @@ def search_stac_items(
         ...     print(item.id)
     """
     if client is None:
-        client = get_stac_client()
+        client = _default_client()
     params = {
         "collections": [collection],
         "datetime": datetime_range,
@@ -276,6 +337,67 @@ def search_stac_items(
     return items[:limit] if limit else items
 
 
+def _make_session(max_workers: int) -> requests.Session:
+    """
+    Cria uma sessão HTTP com pool de conexões (keep-alive) dimensionado para
+    os downloads paralelos e novas tentativas em falhas transitórias.
+
+    Args:
+        max_workers: Número de downloads simultâneos.
+
+    Returns:
+        Sessão requests configurada.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=max_workers,
+        pool_maxsize=max_workers,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _extract_zip_stream(chunks: Iterator[bytes], dest_folder: Path) -> None:
+    """
+    Extrai um zip a partir dos blocos da resposta HTTP, sem gravar o .zip em
+    disco.
+
+    Args:
+        chunks: Iterador com os bytes do arquivo zip.
+        dest_folder: Diretório onde os arquivos serão extraídos.
+
+    Raises:
+        ValueError: Se algum membro do zip apontar para fora de dest_folder.
+    """
+    dest_root = dest_folder.resolve()
+    for file_name, _, file_chunks in stream_unzip(chunks):
+        try:
+            name = file_name.decode("utf-8")
+        except UnicodeDecodeError:
+            name = file_name.decode("cp437")  # codificação padrão do zip
+
+        target = (dest_root / name).resolve()
+        if target != dest_root and dest_root not in target.parents:
+            raise ValueError(f"Caminho inválido no zip: {name}")
+
+        if name.endswith("/"):
+            target.mkdir(parents=True, exist_ok=True)
+            for _ in file_chunks:  # os blocos precisam ser consumidos
+                pass
+            continue
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with open(target, "wb") as f:
+            for chunk in file_chunks:
+                f.write(chunk)
+
+
 def download_item_assets(
     item: Item,
     output_dir: str,
@@ -284,7 +406,7 @@ def download_item_assets(
 ) -> None:
     """
     Baixa os assets especificados de um item STAC. Se um asset for um arquivo .zip,
-    ele será baixado, extraído e o .zip original será removido.
+    ele é extraído durante o download, sem gravar o .zip em disco.
 
     Args:
         item: Objeto Item STAC contendo os assets.
@@ -301,35 +423,40 @@ def download_item_assets(
         if valid_assets is None or key in valid_assets
     ]
 
-    def _download_and_process_asset(key, asset):
+    def _download_and_process_asset(session, key, asset):
         """Função auxiliar para baixar e, se necessário, extrair um asset."""
         asset_filename = Path(asset.href).name
         download_path = dest_folder / asset_filename
 
+        is_zip = (
+            asset.media_type == 'application/zip'
+            or download_path.suffix.lower() == '.zip'
+        )
+
         try:
-            urlretrieve(asset.href, str(download_path))
+            with session.get(asset.href, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                chunks = response.iter_content(DOWNLOAD_CHUNK_SIZE)
+                if is_zip:
+                    # Extrai direto da resposta
+                    _extract_zip_stream(chunks, dest_folder)
+                else:
+                    with open(download_path, "wb") as f:
+                        for chunk in chunks:
+                            f.write(chunk)
             print(f"Download do asset '{key}' concluído.")
 
-            # Verifica se o asset é um arquivo zip e o extrai
-            if (
-                asset.media_type == 'application/zip'
-                or download_path.suffix.lower() == '.zip'
-            ):
-                with zipfile.ZipFile(download_path, 'r') as zip_ref:
-                    zip_ref.extractall(dest_folder)
-
-                # Remove o arquivo .zip após a extração
-                os.remove(download_path)
-
         except Exception as e:
             print(f"ERRO ao baixar ou processar o asset '{key}': {e}")
 
-    # Usa um pool de threads para baixar os assets em paralelo
-    with concurrent.futures.ThreadPoolExecutor(
+    # Usa um pool de threads para baixar os assets em paralelo, todas
+    # compartilhando as conexões da mesma sessão
+    session = _make_session(max_workers)
+    with session, concurrent.futures.ThreadPoolExecutor(
         max_workers=max_workers
     ) as executor:
         futures = [
-            executor.submit(_download_and_process_asset, key, asset)
+            executor.submit(_download_and_process_asset, session, key, asset)
             for key, asset in assets_to_download
         ]
         concurrent.futures.wait(futures)
@@ -368,22 +495,33 @@ def merge_bands_to_multiband(
         return
 
     try:
-        srcs = [rasterio.open(str(p)) for p in paths]
-        meta = srcs[0].meta.copy()
-        meta.update(count=len(srcs))
-
-        out_name = output_filename or f"{item_id}_multiband.tif"
-        out_path = base / out_name
-
-        with rasterio.open(str(out_path), "w", **meta) as dst:
-            for idx, src in enumerate(srcs, start=1):
-                dst.write(src.read(1), idx)
+        # O ExitStack fecha todos os rasters já abertos, mesmo que a abertura
+        # de um deles falhe no meio da lista
+        with ExitStack() as stack:
+            srcs = [stack.enter_context(rasterio.open(str(p))) for p in paths]
+            meta = srcs[0].meta.copy()
+            meta.update(
+                driver="GTiff",
+                count=len(srcs),
+                tiled=True,
+                blockxsize=512,
+                blockysize=512,
+                compress="deflate",
+                predictor=3 if meta["dtype"].startswith("float") else 2,
+                BIGTIFF="IF_SAFER",
+            )
+
+            out_name = output_filename or f"{item_id}_multiband.tif"
+            out_path = base / out_name
+
+            # Copia bloco a bloco: só um bloco de cada banda fica em memória
+            dst = stack.enter_context(rasterio.open(str(out_path), "w", **meta))
+            for _, window in dst.block_windows(1):
+                for idx, src in enumerate(srcs, start=1):
+                    dst.write(src.read(1, window=window), idx, window=window)
 
     except Exception as e:
         print(f"ERRO ao unir as bandas: {e}")
-    finally:
-        for src in srcs:
-            src.close()
 
 
 def mask_raster_with_geobr_polygon(
@@ -410,23 +548,59 @@ def mask_raster_with_geobr_polygon(
         return
 
     with rasterio.open(raster_path) as src:
-        raster_crs = src.crs
-    if geodf.crs != raster_crs:
-        geodf = geodf.to_crs(raster_crs)
+        if geodf.crs != src.crs:
+            geodf = geodf.to_crs(src.crs)
 
-    geoms = list(geodf.geometry)
-    with rasterio.open(raster_path) as src:
-        out_img, out_tf = mask(src, geoms, crop=True)
+        geoms = list(geodf.geometry)
+        area = shapely.union_all(geoms)
+        shapely.prepare(area)
+
+        # Mesmo recorte e preenchimento de rasterio.mask.mask(crop=True),
+        # mas processado bloco a bloco em vez de ler o recorte inteiro
+        crop = geometry_window(src, geoms)
+        nodata = src.nodata if src.nodata is not None else 0
         out_meta = src.meta.copy()
         out_meta.update(
             {
-                "height": out_img.shape[1],
-                "width": out_img.shape[2],
-                "transform": out_tf,
+                "driver": "GTiff",
+                "height": int(crop.height),
+                "width": int(crop.width),
+                "transform": src.window_transform(crop),
+                "tiled": True,
+                "blockxsize": 512,
+                "blockysize": 512,
+                "compress": "deflate",
             }
         )
         if not output_path:
             base, ext = os.path.splitext(raster_path)
             output_path = f"{base}_masked{ext}"
+
         with rasterio.open(output_path, "w", **out_meta) as dst:
-            dst.write(out_img)
+            for _, window in dst.block_windows(1):
+                src_window = Window(
+                    crop.col_off + window.col_off,
+                    crop.row_off + window.row_off,
+                    window.width,
+                    window.height,
+                )
+                block_box = shapely.box(*src.window_bounds(src_window))
+
+                if not area.intersects(block_box):
+                    # Bloco todo fora dos polígonos: não precisa ser lido
+                    data = np.full(
+                        (src.count, int(window.height), int(window.width)),
+                        nodata,
+                        dtype=src.dtypes[0],
+                    )
+                else:
+                    data = src.read(window=src_window)
+                    if not area.contains(block_box):
+                        outside = geometry_mask(
+                            geoms,
+                            out_shape=data.shape[1:],
+                            transform=src.window_transform(src_window),
+                        )
+                        data[:, outside] = nodata
+
+                dst.write(data, window=window)
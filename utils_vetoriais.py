@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo utils_vetoriais
+
+Funções auxiliares compartilhadas pelos scripts do pipeline que trabalham com
+os polígonos das máscaras: distribuição em camadas para rasterização em lote
+e escolha do formato (GeoParquet ou shapefile) dos arquivos intermediários.
+"""
+
+import argparse
+import os
+from collections import defaultdict
+
+import numpy as np
+import shapely
+
+
+def camadas_sem_sobreposicao(geometrias):
+    """
+    Distribui as geometrias em camadas sem interseção entre si, para que cada
+    camada possa ser rasterizada em uma única imagem de rótulos.
+
+    Args:
+        geometrias: Array de geometrias shapely.
+
+    Returns:
+        Array com o índice da camada de cada geometria.
+    """
+    pares = shapely.STRtree(geometrias).query(
+        geometrias, predicate="intersects"
+    )
+    vizinhos = defaultdict(list)
+    for a, b in pares.T:
+        if a != b:
+            vizinhos[a].append(b)
+
+    camadas = np.full(len(geometrias), -1)
+    for i in range(len(geometrias)):
+        usadas = {camadas[j] for j in vizinhos[i]}
+        camada = 0
+        while camada in usadas:
+            camada += 1
+        camadas[i] = camada
+    return camadas
+
+
+def caminho_no_formato(caminho_shp, formato):
+    """Troca a extensão .shp pela do formato escolhido ('shp' ou 'parquet')."""
+    return f"{os.path.splitext(caminho_shp)[0]}.{formato}"
+
+
+def parse_args_formato(descricao, ajuda):
+    """
+    Lê a opção --format (parquet ou shp) comum aos scripts que leem e gravam
+    os arquivos vetoriais intermediários.
+
+    Args:
+        descricao: Descrição do script exibida no --help.
+        ajuda: Texto de ajuda da opção --format.
+
+    Returns:
+        Namespace com o atributo `format`.
+    """
+    parser = argparse.ArgumentParser(description=descricao)
+    parser.add_argument(
+        "--format",
+        choices=["parquet", "shp"],
+        default="parquet",
+        help=ajuda,
+    )
+    return parser.parse_args()